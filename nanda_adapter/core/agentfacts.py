@@ -1,71 +1,408 @@
 # nanda_adapter/core/agentfacts.py
-import os, json, datetime as dt
-from typing import Any, Dict, Optional
+import os, json, hashlib, tempfile, threading, urllib.parse, datetime as dt
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 try:
-    from pymongo import MongoClient  # optional
+    import orjson  # optional, C-accelerated
+    def _dumps(obj) -> bytes: return orjson.dumps(obj)
+    _loads = orjson.loads
 except Exception:
-    MongoClient = None
+    def _dumps(obj) -> bytes: return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    _loads = json.loads
+
+def _copy(obj):
+    """Deep copy of JSON data (records, shard dicts); a serialize round-trip is cheapest."""
+    return _loads(_dumps(obj))
+
+# rewrite a shard's snapshot and truncate its append log once the log grows past this
+_LOG_COMPACT_BYTES = 1 << 20
+# shards kept in memory (with an open log handle) at once; least recently used are closed
+_MAX_OPEN_SHARDS = 256
+
+# one _FileShard (and so one lock) per file path for the whole process, shared by
+# every AgentFacts instance; entries are never dropped, eviction only closes them
+_SHARDS: Dict[str, "_FileShard"] = {}
+# paths of shards currently holding a parsed cache / open log handle, in LRU order
+_OPEN_SHARDS: "OrderedDict[str, None]" = OrderedDict()
+_SHARDS_LOCK = threading.Lock()
+
+
+# longest percent-encoded agent id used verbatim as a shard file name (filesystems
+# cap names at 255 bytes, and the .json.log suffix must still fit)
+_MAX_SHARD_NAME = 200
+
+
+def _shard_name(agent_id: Any) -> str:
+    """
+    Shard file name for an agent id: the id percent-encoded (after str(), since ids
+    may be None, which used to store as "None:<key>"), with "" kept as "%00".
+    Ids whose encoding is too long, and "\\x00" (which would collide with ""), use a
+    truncated prefix plus a blake2b digest instead; percent-encoding never emits
+    "%h", so those can't collide with a plain name. Letter case is kept, so on a
+    case-insensitive filesystem (default macOS / Windows) ids that differ only in
+    case share one shard; use the Mongo backend there if that matters.
+    """
+    agent_id = str(agent_id)
+    name = urllib.parse.quote(agent_id, safe="")
+    if not name:
+        return "%00.json"
+    if name == "%00" or len(name) > _MAX_SHARD_NAME:
+        digest = hashlib.blake2b(agent_id.encode("utf-8"), digest_size=16).hexdigest()
+        name = name[:64] + "%h" + digest
+    return name + ".json"
+
+
+class _FileShard:
+    """
+    One agent's records: a JSON snapshot ({key: record}) plus an append-only
+    JSONL log of later writes. The parsed dict is reused while the snapshot's
+    mtime is unchanged; only log bytes past _log_offset are read on each load.
+    All cache/offset state is guarded by `lock` (reentrant, so callers can hold
+    it across a load + append).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.log_path = path + ".log"
+        self.lock = threading.RLock()
+        self._log = None  # lazily opened "ab" handle
+        self._cache: Optional[Dict[str, Dict[str, Any]]] = None
+        self._cache_mtime: Optional[int] = None
+        self._log_offset = 0
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            try:
+                log_size = os.stat(self.log_path).st_size
+            except OSError:
+                log_size = 0
+            if self._cache is None or mtime != self._cache_mtime or log_size < self._log_offset:
+                data = {}
+                if mtime is not None:
+                    try:
+                        with open(self.path, "rb") as f:
+                            data = _loads(f.read())
+                    except Exception:
+                        data = {}
+                self._cache, self._cache_mtime, self._log_offset = data, mtime, 0
+            if log_size > self._log_offset:
+                self._replay_log()
+            return self._cache
+
+    def _replay_log(self) -> None:
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            chunk = f.read()
+        end = chunk.rfind(b"\n") + 1  # ignore a trailing partial line
+        for line in chunk[:end].splitlines():
+            try:
+                rec = _loads(line)
+                self._cache[rec["key"]] = rec
+            except Exception:
+                continue
+        self._log_offset += end
+
+    def append(self, recs) -> None:
+        with self.lock:
+            data = self.load()
+            lines = [_dumps(r) for r in recs]
+            blob = b"".join(line + b"\n" for line in lines)
+            if self._log is None:
+                self._log = open(self.log_path, "ab")
+            start = os.fstat(self._log.fileno()).st_size
+            tail = b""
+            if start > self._log_offset:
+                with open(self.log_path, "rb") as f:
+                    f.seek(self._log_offset)
+                    tail = f.read(start - self._log_offset)
+                if not tail.endswith(b"\n"):
+                    # a crash mid-append left a partial last line: terminate it so
+                    # it can't swallow the first record written here
+                    blob = b"\n" + blob
+            self._log.write(blob)
+            self._log.flush()
+            # a tail without any newline is only that torn fragment, which replay skips
+            if b"\n" not in tail and os.fstat(self._log.fileno()).st_size == start + len(blob):
+                # cache parsed copies, not the caller's objects, which it may mutate later
+                for r, line in zip(recs, lines):
+                    data[r["key"]] = _loads(line)
+                self._log_offset = start + len(blob)
+            # else another writer appended too; the next load replays both in order
+            if self._log_offset > _LOG_COMPACT_BYTES:
+                self.compact()
+
+    def save(self, data: Dict[str, Dict[str, Any]]) -> None:
+        with self.lock:
+            # write to a temp file in the same dir, then atomically swap it in
+            with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(self.path), suffix=".tmp", delete=False) as f:
+                f.write(_dumps(data))
+            try:
+                os.replace(f.name, self.path)
+            except Exception:
+                os.unlink(f.name)
+                raise
+            self._cache = data
+            self._cache_mtime = os.stat(self.path).st_mtime_ns
+
+    def compact(self) -> None:
+        with self.lock:
+            data = self.load()
+            self.save(data)
+            with open(self.log_path, "ab") as f:
+                f.truncate(0)
+            self._log_offset = 0
+
+    def close(self) -> None:
+        """Drop the log handle and parsed cache; the shard (and its lock) stays usable."""
+        with self.lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self._cache, self._cache_mtime, self._log_offset = None, None, 0
+
 
 class AgentFacts:
     """
     Minimal AgentFacts store:
       - If MONGO_URL provided and PyMongo available, use MongoDB
-      - Else fall back to a local JSON file (agent_facts.json)
+      - Else fall back to local files, one shard per agent under agent_facts/
+        (a JSON snapshot plus an append-only JSONL log of later writes); on a
+        case-insensitive filesystem, agent ids differing only in case share a shard
     Sync API so you can call from non-async code.
     """
+    # (mongo_url, db_name) pairs whose indexes were already ensured in this process
+    _indexed = set()
+
     def __init__(self, mongo_url: Optional[str] = None, db_name: str = "agent_registry"):
         self._use_mongo = False
         self._col = None
-        self._file_path = os.path.join(os.getcwd(), "agent_facts.json")
+        self._dir_path = os.path.join(os.getcwd(), "agent_facts")
 
-        if mongo_url and MongoClient is not None:
+        if mongo_url:
             try:
-                client = MongoClient(mongo_url, serverSelectionTimeoutMS=1500)
+                from pymongo import MongoClient  # optional, only needed for the Mongo backend
+                client = MongoClient(
+                    mongo_url,
+                    serverSelectionTimeoutMS=1500,
+                    connectTimeoutMS=1500,
+                    socketTimeoutMS=5000,
+                    maxPoolSize=50,
+                    retryWrites=True,
+                    appname="nanda",
+                )
                 db = client[db_name]
                 # quick ping
-                _ = client.server_info()
+                client.admin.command("ping")
                 self._col = db["agent_facts"]
                 self._use_mongo = True
+                self._ensure_indexes((mongo_url, db_name))
             except Exception:
                 self._use_mongo = False  # fallback to file
 
+        if not self._use_mongo:
+            self._migrate_legacy_file()
+
+    def _ensure_indexes(self, ident) -> None:
+        if ident in AgentFacts._indexed:
+            return
+        try:
+            # (agent_id, key) serves get/set; its agent_id prefix also serves list()
+            self._col.create_index([("agent_id", 1), ("key", 1)], unique=True, background=True)
+            AgentFacts._indexed.add(ident)
+        except Exception as e:
+            print(f"[agentfacts] index creation skipped: {e}")
+
     def _now(self) -> str:
         return dt.datetime.utcnow().isoformat()
 
-    def _file_load(self) -> Dict[str, Dict[str, Any]]:
-        if not os.path.exists(self._file_path):
-            return {}
+    def _shard(self, agent_id: str) -> _FileShard:
+        path = os.path.join(self._dir_path, _shard_name(agent_id))
+        evicted = []
+        with _SHARDS_LOCK:
+            shard = _SHARDS.get(path)
+            if shard is None:
+                os.makedirs(self._dir_path, exist_ok=True)
+                shard = _SHARDS[path] = _FileShard(path)
+            _OPEN_SHARDS[path] = None
+            _OPEN_SHARDS.move_to_end(path)
+            while len(_OPEN_SHARDS) > _MAX_OPEN_SHARDS:
+                evicted.append(_SHARDS[_OPEN_SHARDS.popitem(last=False)[0]])
+        # close outside _SHARDS_LOCK: a thread may hold an evicted shard's lock
+        # while it waits for _SHARDS_LOCK to open another shard
+        for old in evicted:
+            old.close()
+        return shard
+
+    def _file_load(self, agent_id: str) -> Dict[str, Dict[str, Any]]:
+        return self._shard(agent_id).load()
+
+    def _file_append(self, recs) -> None:
+        by_agent: Dict[str, list] = {}
+        for r in recs:
+            by_agent.setdefault(r["agent_id"], []).append(r)
+        for agent_id, shard_recs in by_agent.items():
+            self._shard(agent_id).append(shard_recs)
+
+    def _migrate_legacy_file(self) -> None:
+        """
+        Split a pre-sharding agent_facts.json (+ .log) into per-agent shards, once.
+        Gated on the legacy file itself (renamed to *.migrated when done), not on
+        agent_facts/ existing: writes made after a failed run create that directory,
+        and are merged with rather than replaced by the legacy records.
+        """
+        legacy = os.path.join(os.getcwd(), "agent_facts.json")
+        if not os.path.isfile(legacy) or os.path.exists(legacy + ".migrated"):
+            return
         try:
-            with open(self._file_path, "r") as f:
-                return json.load(f)
-        except Exception:
-            return {}
+            with open(legacy, "rb") as f:
+                data = _loads(f.read())
+            recs = list(data.values())
+            if os.path.isfile(legacy + ".log"):
+                with open(legacy + ".log", "rb") as f:
+                    for line in f:
+                        try:
+                            recs.append(_loads(line))
+                        except Exception:
+                            continue  # torn last line
+            by_agent: Dict[Any, Dict[str, Dict[str, Any]]] = {}
+            for rec in recs:
+                if not isinstance(rec, dict) or "agent_id" not in rec or not isinstance(rec.get("key"), str):
+                    print(f"[agentfacts] legacy record skipped (malformed): {str(rec)[:200]}")
+                    continue
+                by_agent.setdefault(rec["agent_id"], {})[rec["key"]] = rec
+            for agent_id, legacy_recs in by_agent.items():
+                shard = self._shard(agent_id)
+                with shard.lock:
+                    # records already in the shard were written after the legacy file: they win.
+                    # save() swaps each shard in atomically, so a rerun after a failure is safe.
+                    merged = dict(legacy_recs)
+                    merged.update(shard.load())
+                    shard.save(merged)
+            for path in (legacy, legacy + ".log"):
+                if os.path.exists(path):
+                    os.replace(path, path + ".migrated")
+        except Exception as e:
+            print(f"[agentfacts] legacy file migration failed, will retry next start: {e}")
 
-    def _file_save(self, data: Dict[str, Dict[str, Any]]) -> None:
-        with open(self._file_path, "w") as f:
-            json.dump(data, f, indent=2)
+    def compact(self) -> None:
+        """Fold each open shard's append log into its snapshot and truncate the log."""
+        if self._use_mongo:
+            return
+        prefix = self._dir_path + os.sep
+        with _SHARDS_LOCK:
+            shards = [_SHARDS[p] for p in _OPEN_SHARDS if p.startswith(prefix)]
+        for shard in shards:
+            shard.compact()
 
     def set(self, agent_id: str, key: str, value: Dict[str, Any]) -> None:
         rec = {"agent_id": agent_id, "key": key, "value": value, "ts": self._now()}
         if self._use_mongo:
             self._col.update_one({"agent_id": agent_id, "key": key}, {"$set": rec}, upsert=True)
             return
-        data = self._file_load()
-        data[f"{agent_id}:{key}"] = rec
-        self._file_save(data)
+        self._file_append([rec])
+
+    def bulk_set(self, records: Iterable[Tuple[str, str, Dict[str, Any]]]) -> None:
+        """Write many (agent_id, key, value) records in one round-trip / one log append."""
+        self.bulk_inc((), records)
+
+    def bulk_inc(self,
+                 increments: Iterable[Tuple[str, str, Dict[str, int], Dict[str, Any]]],
+                 records: Iterable[Tuple[str, str, Dict[str, Any]]] = ()) -> None:
+        """
+        Atomically add deltas to numeric value fields, plus plain set() records, in one round-trip.
+        Each increment is (agent_id, key, {field: delta}, {field: value to set alongside}).
+        """
+        ts = self._now()
+        incs = list(increments)
+        recs = list({(a, k): {"agent_id": a, "key": k, "value": v, "ts": ts} for a, k, v in records}.values())
+        if not incs and not recs:
+            return
+        if self._use_mongo:
+            from pymongo import UpdateOne
+            ops = []
+            for a, k, deltas, fields in incs:
+                sets = {f"value.{f}": v for f, v in fields.items()}
+                sets["ts"] = ts
+                ops.append(UpdateOne(
+                    {"agent_id": a, "key": k},
+                    {"$inc": {f"value.{f}": d for f, d in deltas.items()}, "$set": sets},
+                    upsert=True,
+                ))
+            ops += [UpdateOne({"agent_id": r["agent_id"], "key": r["key"]}, {"$set": r}, upsert=True) for r in recs]
+            self._col.bulk_write(ops, ordered=False)
+            return
+        by_agent: Dict[str, Tuple[list, list]] = {}
+        for inc in incs:
+            by_agent.setdefault(inc[0], ([], []))[0].append(inc)
+        for r in recs:
+            by_agent.setdefault(r["agent_id"], ([], []))[1].append(r)
+        for agent_id, (shard_incs, shard_recs) in by_agent.items():
+            shard = self._shard(agent_id)
+            # read-modify-append under the shard lock so concurrent deltas never
+            # start from a stale balance
+            with shard.lock:
+                data = shard.load()
+                current: Dict[str, Dict[str, Any]] = {}
+                for a, k, deltas, fields in shard_incs:
+                    rec = current.get(k) or data.get(k) or {}
+                    value = dict(rec.get("value") or {})
+                    for f, d in deltas.items():
+                        value[f] = value.get(f, 0) + d
+                    value.update(fields)
+                    current[k] = {"agent_id": a, "key": k, "value": value, "ts": ts}
+                shard.append(list(current.values()) + shard_recs)
+
+    def debit(self, agent_id: str, key: str, field: str, amount: int,
+              fields: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Atomically subtract amount from a numeric value field, only if it is at
+        least amount; `fields` are set alongside. Returns False (writing nothing)
+        when the record is missing or the field is too low.
+        """
+        ts = self._now()
+        fields = fields or {}
+        if self._use_mongo:
+            sets = {f"value.{f}": v for f, v in fields.items()}
+            sets["ts"] = ts
+            res = self._col.update_one(
+                {"agent_id": agent_id, "key": key, f"value.{field}": {"$gte": amount}},
+                {"$inc": {f"value.{field}": -amount}, "$set": sets},
+            )
+            return res.matched_count == 1
+        shard = self._shard(agent_id)
+        with shard.lock:
+            rec = shard.load().get(key) or {}
+            value = dict(rec.get("value") or {})
+            if value.get(field, 0) < amount:
+                return False
+            value[field] -= amount
+            value.update(fields)
+            shard.append([{"agent_id": agent_id, "key": key, "value": value, "ts": ts}])
+        return True
 
     def get(self, agent_id: str, key: str) -> Optional[Dict[str, Any]]:
         if self._use_mongo:
             return self._col.find_one({"agent_id": agent_id, "key": key}, {"_id": 0})
-        data = self._file_load()
-        return data.get(f"{agent_id}:{key}")
+        # the cache is shared process-wide: hand out copies so callers can't mutate it
+        rec = self._file_load(agent_id).get(key)
+        return _copy(rec) if rec is not None else None
+
+    def exists(self, agent_id: str, key: str) -> bool:
+        if self._use_mongo:
+            return self._col.find_one({"agent_id": agent_id, "key": key}, {"_id": 1}) is not None
+        return key in self._file_load(agent_id)
 
     def list(self, agent_id: str) -> Dict[str, Dict[str, Any]]:
         if self._use_mongo:
             out = {}
-            for doc in self._col.find({"agent_id": agent_id}, {"_id": 0}):
+            proj = {"_id": 0, "agent_id": 1, "key": 1, "value": 1, "ts": 1}
+            for doc in self._col.find({"agent_id": agent_id}, proj).batch_size(500):
                 out[doc["key"]] = doc
             return out
-        data = self._file_load()
-        return {k.split(":", 1)[1]: v for k, v in data.items() if k.startswith(f"{agent_id}:")}
+        shard = self._shard(agent_id)
+        with shard.lock:
+            return _copy(shard.load())
@@ -6,10 +6,16 @@ Payment and A2A quote system for NANDA agents.
 - Sends payment quotes over A2A (x402-compatible).
 """
 
-import os, time, json, hashlib, requests
-from datetime import datetime
+import os, re, time, json, hashlib, functools, threading, asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from nanda_adapter.core.agentfacts import AgentFacts
 
+try:
+    import orjson  # optional
+except Exception:
+    orjson = None
+
 REGISTRY_URL = os.getenv("REGISTRY_URL")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 MONGO_URL = os.getenv("MONGO_URL")
@@ -17,27 +23,124 @@ DB_NAME = os.getenv("DB_NAME", "agent_registry")
 
 facts = AgentFacts(MONGO_URL, DB_NAME)
 
+# overlaps independent HTTP calls with local AgentFacts reads/writes
+_EXEC = ThreadPoolExecutor(max_workers=8, thread_name_prefix="payments")
+
+# ---- http -----------------------------------------------------------------
+# requests is imported on first use so importing this module stays cheap
+def _make_session(retry_posts: bool = False):
+    """
+    Session with keep-alive pooling so repeat calls skip the TCP/TLS handshake.
+    retry_posts also retries POSTs on 502/503/504; only set it where the POST is
+    idempotent (registry lookups, Claude), never for A2A quotes.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    if retry_posts:
+        retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}, raise_on_status=False)
+    else:
+        retry = Retry(total=2, backoff_factor=0.2)  # connection errors only for POSTs
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@functools.lru_cache(maxsize=None)
+def _session():
+    """Shared session for peer agents (A2A)."""
+    return _make_session()
+
+@functools.lru_cache(maxsize=None)
+def _registry_session():
+    """Registry-only session; /resolve is a lookup, so it is safe to retry."""
+    return _make_session(retry_posts=True)
+
+@functools.lru_cache(maxsize=None)
+def _claude_session():
+    """Anthropic-only session; carries the API key headers."""
+    session = _make_session(retry_posts=True)
+    session.headers.update({
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json",
+    })
+    if ANTHROPIC_API_KEY:
+        session.headers["x-api-key"] = ANTHROPIC_API_KEY
+    return session
+
+# ---- caches ---------------------------------------------------------------
+class _TTLCache:
+    """Small thread-safe LRU with per-entry expiry (stdlib-only stand-in for cachetools.TTLCache)."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[1] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+_SEEN_CACHE = _TTLCache(maxsize=2048, ttl=60)  # (aid, qkey) -> True once recorded
+_RESOLVE_CACHE = _TTLCache(maxsize=1024, ttl=300)  # agent id -> registry record
+_ACCEPT_CACHE = _TTLCache(maxsize=4096, ttl=3600)  # card digest -> Claude decision
+
 # ---- helpers --------------------------------------------------------------
-def _now_iso(): return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-def _qhash(s: str): return hashlib.sha256(s.encode("utf-8")).hexdigest()[:16]
+_SEC_FMT = "%Y-%m-%dT%H:%M:%SZ"
+_now_last = (-1, "")  # (epoch second, formatted), reformatted once per second
+
+def _now_iso(t: float | None = None) -> str:
+    global _now_last
+    sec = int(time.time() if t is None else t)
+    last_sec, last_str = _now_last
+    if sec == last_sec: return last_str
+    out = time.strftime(_SEC_FMT, time.gmtime(sec))
+    _now_last = (sec, out)
+    return out
+@functools.lru_cache(maxsize=4096)
+def _qhash_v1(s: str): return hashlib.sha256(s.encode("utf-8")).hexdigest()[:16]
+@functools.lru_cache(maxsize=4096)
+def _qhash_v2(s: str): return hashlib.blake2b(s.encode("utf-8"), digest_size=8).hexdigest()
+_qhash = _qhash_v2  # v1 only for reading q: keys written before the switch
+# pre-blake2b q: keys still count as "seen" until this UTC date (YYYY-MM-DD); "" disables
+QHASH_V1_FALLBACK_UNTIL = os.getenv("QHASH_V1_FALLBACK_UNTIL", "2027-01-14")
+def _qhash_v1_fallback() -> bool: return _now_iso()[:10] < QHASH_V1_FALLBACK_UNTIL
 def _af_get(aid, key): return facts.get(aid, key)
-def _af_set(aid, key, val): facts.set(aid, key, val)
+def _af_bulk_inc(incs, records=()): facts.bulk_inc(incs, records)
+
+def _flush_writes(records, incs=()):
+    _af_bulk_inc(incs, records)
+    for aid, key, val in records:
+        if val.get("category") == "interaction": _SEEN_CACHE.set((aid, key), True)
+
+def _seen(aid, key) -> bool:
+    if _SEEN_CACHE.get((aid, key)):
+        return True
+    hit = facts.exists(aid, key)
+    if hit: _SEEN_CACHE.set((aid, key), True)
+    return hit
 
 def _points_get(owner: str) -> int:
     row = _af_get(owner, f"wallet:{owner}")
     return int(row["value"].get("balance", 0)) if row else 0
 
-def _points_set(owner: str, balance: int):
-    _af_set(owner, f"wallet:{owner}", {
-        "@type": "AgentFacts",
-        "category": "wallet",
-        "owner": owner,
-        "balance": balance,
-        "observedAt": _now_iso()
-    })
-
-def _txn_add(txn_id, from_user, to_agent, points, question, peer_agent_id):
-    _af_set(to_agent, f"txn:{txn_id}", {
+def _txn_rec(txn_id, from_user, to_agent, points, question, peer_agent_id, observed_at: str | None = None) -> dict:
+    return {
         "@type": "AgentFacts",
         "category": "transaction",
         "txnId": txn_id,
@@ -46,40 +149,110 @@ def _txn_add(txn_id, from_user, to_agent, points, question, peer_agent_id):
         "points": points,
         "question": question,
         "peer_agent": peer_agent_id,
-        "observedAt": _now_iso()
-    })
+        "observedAt": observed_at or _now_iso()
+    }
+
+def _wallet_fields(owner: str, observed_at: str | None = None) -> dict:
+    return {
+        "@type": "AgentFacts",
+        "category": "wallet",
+        "owner": owner,
+        "observedAt": observed_at or _now_iso()
+    }
+
+def _wallet_delta(owner: str, delta: int, observed_at: str | None = None) -> tuple:
+    return (owner, f"wallet:{owner}", {"balance": delta}, _wallet_fields(owner, observed_at))
+
+def _af_debit(owner: str, points: int, observed_at: str | None = None) -> bool:
+    """Take points from owner's wallet only if the balance covers them, in one atomic write."""
+    return facts.debit(owner, f"wallet:{owner}", "balance", points, _wallet_fields(owner, observed_at))
 
 def _resolve_agent(agent_or_id: str):
+    cached = _RESOLVE_CACHE.get(agent_or_id)
+    if cached is not None:
+        return cached
     try:
-        r = requests.post(f"{REGISTRY_URL}/resolve", json={"agent_id": agent_or_id}, timeout=10)
+        r = _registry_session().post(f"{REGISTRY_URL}/resolve", json={"agent_id": agent_or_id}, timeout=10)
         if r.status_code == 404: return None
         r.raise_for_status()
-        return r.json()
+        info = r.json()
+        if info: _RESOLVE_CACHE.set(agent_or_id, info)
+        return info
     except Exception as e:
         print(f"[resolve] error: {e}")
         return None
 
-def _send_a2a(receiver_id: str, payload: dict) -> dict:
-    info = _resolve_agent(receiver_id)
+def _send_a2a(receiver_id: str, payload: dict, info: dict | None = None) -> dict:
+    info = info or _resolve_agent(receiver_id)
     if not info or not info.get("agent_url"):
         raise RuntimeError("A2A resolution failed")
     endpoint = info["agent_url"].rstrip("/") + "/handle_external_message"
-    r = requests.post(endpoint, json={"from": os.getenv("AGENT_ID","default"), "message": payload}, timeout=20)
+    r = _session().post(endpoint, json={"from": os.getenv("AGENT_ID","default"), "message": payload}, timeout=20)
     r.raise_for_status()
     return r.json()
 
+def _send_a2a_safe(receiver_id: str, payload: dict, info: dict | None = None) -> dict:
+    try: return _send_a2a(receiver_id, payload, info)
+    except Exception as e: return {"error": str(e)}
+
+# how often the pre-heuristic settled the acceptance check without Claude
+_HEURISTIC_STATS = {"hits": 0, "misses": 0}
+_HEURISTIC_LOCK = threading.Lock()
+
+def _count_heuristic(kind: str) -> None:
+    with _HEURISTIC_LOCK:
+        _HEURISTIC_STATS[kind] += 1
+
+def _caps_has(caps, needles) -> bool:
+    """True if any needle is a substring of a key or string value anywhere in caps."""
+    stack = [caps]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, dict):
+            for k, v in x.items():
+                if isinstance(k, str) and any(n in k for n in needles): return True
+                stack.append(v)
+        elif isinstance(x, str):
+            if any(n in x for n in needles): return True
+        elif isinstance(x, (list, tuple)):
+            stack.extend(x)
+    return False
+
+def _card_digest(card) -> bytes | None:
+    try:
+        raw = (orjson.dumps(card, option=orjson.OPT_SORT_KEYS) if orjson is not None
+               else json.dumps(card, sort_keys=True).encode("utf-8"))
+    except Exception:
+        return None  # unserializable card: just skip the cache
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
 def _claude_can_accept_payment(peer_card: dict | None) -> bool:
     card = peer_card or {}
     base = card.get("card") if isinstance(card.get("card"), dict) else card
     econ = (base or {}).get("economy", {})
     caps = (base or {}).get("capabilities", {})
+    # cards come from peers: tolerate null / scalar economy (_caps_has walks any caps shape)
+    econ = econ if isinstance(econ, dict) else {}
+
+    has_points = isinstance(econ.get("pricing"), dict)
+    has_cap = _caps_has(caps, ("payments.points", "x402"))
 
     # heuristic if no API key
     if not ANTHROPIC_API_KEY:
-        has_points = isinstance(econ.get("pricing"), dict)
-        has_cap = "payments.points" in json.dumps(caps) or "x402" in json.dumps(caps)
         return has_points or has_cap
 
+    # both signals present: confident enough to skip Claude entirely
+    if has_points and has_cap:
+        _count_heuristic("hits")
+        return True
+    _count_heuristic("misses")
+
+    # same card -> same answer; skip the round-trip on repeat peers
+    key = _card_digest(base)
+    cached = _ACCEPT_CACHE.get(key) if key is not None else None
+    if cached is not None:
+        return cached
+
     # real Claude query
     try:
         prompt = (
@@ -87,35 +260,32 @@ def _claude_can_accept_payment(peer_card: dict | None) -> bool:
             "Return only 'true' or 'false'.\n\n"
             f"AgentFacts: {json.dumps(base, ensure_ascii=False)}"
         )
-        resp = requests.post(
+        resp = _claude_session().post(
             "https://api.anthropic.com/v1/messages",
-            headers={
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            },
             json={
                 "model": "claude-3-5-sonnet-20240620",
-                "max_tokens": 20,
+                "max_tokens": 4,
                 "messages": [{"role": "user", "content": prompt}]
             },
             timeout=20
         )
         resp.raise_for_status()
-        text = "".join(block.get("text","") if isinstance(block,dict) else block for block in resp.json().get("content",[]))
-        t = text.strip().lower()
-        return "true" in t and "false" not in t
+        # the answer is a single true/false token: read only the first text block
+        data = orjson.loads(resp.content) if orjson is not None else resp.json()
+        text = next((b.get("text","") for b in data.get("content") or [] if isinstance(b, dict)), "")
+        t = text[:16].strip().lower()
+        decision = "true" in t and "false" not in t
+        if key is not None: _ACCEPT_CACHE.set(key, decision)
+        return decision
     except Exception as e:
         print(f"[claude] fallback: {e}")
         return bool(econ or caps)
 
+_KW_RE = re.compile(r"matrix|gaussian|proof|opencv|unreal|swiftui|jetson|agent", re.I)
+
 def _decide_points(question: str, seen_before: bool) -> int:
-    base = 6
-    if len(question) > 120: base += 2
-    if any(k in question.lower() for k in ["matrix","gaussian","proof","opencv","unreal","swiftui","jetson","agent"]):
-        base += 2
-    if seen_before: base -= 2
-    return max(5, min(10, base))
+    base = 6 + (2 if len(question) > 120 else 0) + (2 if _KW_RE.search(question) else 0) - (2 if seen_before else 0)
+    return 5 if base < 5 else 10 if base > 10 else base
 
 # ---- Main quote & charge ---------------------------------------------------
 def quote_and_charge_points_via_a2a(username: str, peer_identifier: str, question: str, use_x402: bool = True) -> dict:
@@ -123,38 +293,40 @@ def quote_and_charge_points_via_a2a(username: str, peer_identifier: str, questio
     if not peer: return {"ok": False, "error": "peer_not_found"}
     peer_id = peer["agent_id"]
 
-    can_accept = _claude_can_accept_payment(peer)
+    # Claude check runs while we look up whether the question was seen
+    claude_fut = _EXEC.submit(_claude_can_accept_payment, peer)
+    self_id = os.getenv("AGENT_ID","default")
+    qkey = f"q:{username}:{_qhash(question)}"
+    seen = _seen(self_id, qkey) or (_qhash_v1_fallback() and _seen(self_id, f"q:{username}:{_qhash_v1(question)}"))
+
+    can_accept = claude_fut.result()
     if not can_accept:
         return {"ok": False, "error": "peer_cannot_accept_payment"}
 
-    self_id = os.getenv("AGENT_ID","default")
-    qkey = f"q:{username}:{_qhash(question)}"
-    seen = _af_get(self_id, qkey) is not None
-    _af_set(self_id, qkey, {
+    t = time.time()
+    now = _now_iso(t)
+    # the interaction record isn't read again here, so it rides along with
+    # whatever else this call writes in a single bulk write
+    pending_writes = [(self_id, qkey, {
         "@type": "AgentFacts",
         "category": "interaction",
         "user": username,
         "question": question,
-        "observedAt": _now_iso()
-    })
+        "observedAt": now
+    })]
 
     if seen:
         payload = {"type": "quote", "points": 0, "reason": "repeat_question"}
-        try: a2a_resp = _send_a2a(peer_id, payload)
-        except Exception as e: a2a_resp = {"error": str(e)}
-        return {"ok": True, "charged": False, "points": 0, "a2a_response": a2a_resp}
+        # record the interaction first, as on the charged path: a failed write
+        # must not leave a send running in the background
+        _flush_writes(pending_writes)
+        return {"ok": True, "charged": False, "points": 0, "a2a_response": _send_a2a_safe(peer_id, payload, peer)}
 
     points = _decide_points(question, seen_before=False)
-    user_bal = _points_get(username)
-    if user_bal < points:
-        return {"ok": False, "error": "insufficient_points", "required": points, "available": user_bal}
-
-    _points_set(username, user_bal - points)
-    agent_bal = _points_get(self_id)
-    _points_set(self_id, agent_bal + points)
-
-    txn_id = f"txn_{int(time.time())}_{_qhash(username+question)}"
-    _txn_add(txn_id, username, self_id, points, question, peer_id)
+    # the balance check is part of the debit itself, so concurrent quotes can't overdraw
+    if not _af_debit(username, points, now):
+        _flush_writes(pending_writes)
+        return {"ok": False, "error": "insufficient_points", "required": points, "available": _points_get(username)}
 
     payload = {
         "type": "x402.quote" if use_x402 else "price_quote",
@@ -162,7 +334,28 @@ def quote_and_charge_points_via_a2a(username: str, peer_identifier: str, questio
         "currency": "POINTS",
         "question": question
     }
-    try: a2a_resp = _send_a2a(peer_id, payload)
-    except Exception as e: a2a_resp = {"error": str(e)}
 
+    txn_id = f"txn_{int(t)}_{_qhash(username+question)}"
+    pending_writes.append((self_id, f"txn:{txn_id}", _txn_rec(txn_id, username, self_id, points, question, peer_id, now)))
+    # the charge must be persisted before the peer is told it was paid. The credit
+    # is its own single-op write (retried by the driver on network errors), so
+    # a failure there means it didn't apply and only then is the debit refunded.
+    # Batching it with the records would let a failed upsert refund an applied credit.
+    try:
+        _af_bulk_inc([_wallet_delta(self_id, points, now)])
+    except Exception:
+        _af_bulk_inc([_wallet_delta(username, points, now)])  # refund the debit
+        raise
+    # the points have moved; a failure here leaves the balances consistent
+    _flush_writes(pending_writes)
+
+    a2a_resp = _send_a2a_safe(peer_id, payload, peer)
     return {"ok": True, "charged": True, "points": points, "txn_id": txn_id, "a2a_response": a2a_resp}
+
+async def quote_and_charge_points_via_a2a_async(username: str, peer_identifier: str, question: str, use_x402: bool = True) -> dict:
+    """Awaitable variant for async callers; runs the pooled sync path off the event loop."""
+    loop = asyncio.get_running_loop()
+    # default executor, not _EXEC: the sync path itself submits work to _EXEC
+    return await loop.run_in_executor(
+        None, functools.partial(quote_and_charge_points_via_a2a, username, peer_identifier, question, use_x402)
+    )
@@ -47,7 +47,8 @@ setup(
     extras_require={
         "langchain": ["langchain-core", "langchain-anthropic"],
         "crewai": ["crewai", "langchain-anthropic"],
-        "all": ["langchain-core", "langchain-anthropic", "crewai"]
+        "fast": ["orjson"],
+        "all": ["langchain-core", "langchain-anthropic", "crewai", "orjson"]
     },
     entry_points={
         "console_scripts": [
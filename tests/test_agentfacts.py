@@ -0,0 +1,234 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from pymongo import UpdateOne
+
+from nanda_adapter.core import agentfacts
+from nanda_adapter.core.agentfacts import AgentFacts
+
+
+class FileBackendTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        self.facts = AgentFacts()
+
+    def _run_threads(self, target, n=8):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_concurrent_set_get_keeps_every_record(self):
+        def work(i):
+            for j in range(300):
+                self.facts.set("agent", f"k{i}:{j}", {"j": j})
+                self.facts.get("agent", f"k{i}:{j}")
+
+        self._run_threads(work)
+        self.assertEqual(len(self.facts.list("agent")), 2400)
+        self.assertEqual(len(AgentFacts().list("agent")), 2400)
+
+    def test_concurrent_bulk_inc_does_not_lose_deltas(self):
+        def work(i):
+            for _ in range(100):
+                self.facts.bulk_inc([("u", "wallet:u", {"balance": -1}, {}), ("me", "wallet:me", {"balance": 1}, {})])
+
+        self._run_threads(work)
+        self.assertEqual(self.facts.get("u", "wallet:u")["value"]["balance"], -800)
+        self.assertEqual(AgentFacts().get("me", "wallet:me")["value"]["balance"], 800)
+
+    def test_concurrent_bulk_inc_across_instances_and_evictions(self):
+        instances = [self.facts, AgentFacts()]
+
+        def work(i):
+            facts = instances[i % 2]
+            for j in range(200):
+                # touching other agents' shards keeps evicting "u" from the open set
+                facts.bulk_inc([("u", "wallet:u", {"balance": -1}, {}), (f"o{j % 3}", "wallet", {"balance": 1}, {})])
+
+        with mock.patch.object(agentfacts, "_MAX_OPEN_SHARDS", 2):
+            self._run_threads(work)
+        self.assertEqual(self.facts.get("u", "wallet:u")["value"]["balance"], -1600)
+        self.assertEqual(AgentFacts().get("u", "wallet:u")["value"]["balance"], -1600)
+
+    def test_concurrent_debits_never_overdraw(self):
+        self.facts.set("u", "wallet:u", {"balance": 50})
+        taken = []
+
+        def work(i):
+            for _ in range(10):
+                if AgentFacts().debit("u", "wallet:u", "balance", 3, {"owner": "u"}):
+                    taken.append(3)
+
+        self._run_threads(work)
+        self.assertEqual(sum(taken), 48)
+        self.assertEqual(AgentFacts().get("u", "wallet:u")["value"], {"balance": 2, "owner": "u"})
+        self.assertFalse(self.facts.debit("nobody", "wallet:nobody", "balance", 1))
+
+    def test_bulk_set_later_record_wins(self):
+        self.facts.bulk_set([("a", "k", {"n": 1}), ("b", "k", {"n": 2}), ("a", "k", {"n": 3})])
+        self.assertEqual(AgentFacts().get("a", "k")["value"], {"n": 3})
+        self.assertEqual(AgentFacts().get("b", "k")["value"], {"n": 2})
+
+    def test_append_after_torn_log_line_keeps_record(self):
+        self.facts.set("u", "wallet:u", {"balance": 20})
+        with open(os.path.join("agent_facts", "u.json.log"), "ab") as f:
+            f.write(b'{"agent_id":"u","key":"wallet:u","val')  # crash mid-append
+        facts = AgentFacts()
+        self.assertEqual(facts.get("u", "wallet:u")["value"]["balance"], 20)
+        facts.bulk_inc([("u", "wallet:u", {"balance": -8}, {})])
+        self.assertEqual(facts.get("u", "wallet:u")["value"]["balance"], 12)
+        self.assertEqual(AgentFacts().get("u", "wallet:u")["value"]["balance"], 12)
+
+    def test_reads_and_writes_do_not_share_cached_records(self):
+        value = {"balance": 20}
+        self.facts.set("u", "wallet:u", value)
+        value["balance"] = 500
+        self.facts.get("u", "wallet:u")["value"]["balance"] = 999
+        self.facts.list("u")["wallet:u"]["value"]["balance"] = 999
+        self.assertEqual(AgentFacts().get("u", "wallet:u")["value"], {"balance": 20})
+        self.assertFalse(self.facts.debit("u", "wallet:u", "balance", 30))
+
+    def test_long_and_colliding_agent_ids_get_their_own_shards(self):
+        ids = ["a" * 300, "中" * 40, "", "\x00"]
+        for i, agent_id in enumerate(ids):
+            self.facts.set(agent_id, "k", {"i": i})
+        facts = AgentFacts()
+        for i, agent_id in enumerate(ids):
+            self.assertEqual(facts.get(agent_id, "k")["value"], {"i": i})
+        self.assertEqual(len(os.listdir("agent_facts")), len(ids))  # one .log per id
+
+    def test_non_str_agent_id(self):
+        self.facts.set(None, "card:self", {"x": 1})
+        self.assertEqual(self.facts.get(None, "card:self")["value"], {"x": 1})
+        self.assertIn("card:self", AgentFacts().list("None"))
+
+
+class LegacyMigrationTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        # a baseline agent_facts.json ({"<agent_id>:<key>": record}) plus its append log
+        rec = lambda a, k, v: {"agent_id": a, "key": k, "value": v, "ts": "2026-01-01T00:00:00"}
+        with open("agent_facts.json", "w") as f:
+            json.dump({"me:wallet:me": rec("me", "wallet:me", {"balance": 5}),
+                       "u/1:wallet:u/1": rec("u/1", "wallet:u/1", {"balance": 30})}, f, indent=2)
+        with open("agent_facts.json.log", "w") as f:
+            f.write(json.dumps(rec("me", "wallet:me", {"balance": 7})) + "\n")
+            f.write(json.dumps(rec(None, "card:self", {"x": 1})) + "\n")
+            f.write('{"agent_id":"me","key":"wal')  # torn last line
+
+    def test_migrates_snapshot_and_log(self):
+        facts = AgentFacts()
+        self.assertEqual(facts.get("me", "wallet:me")["value"], {"balance": 7})
+        self.assertEqual(facts.get("u/1", "wallet:u/1")["value"], {"balance": 30})
+        self.assertEqual(facts.get(None, "card:self")["value"], {"x": 1})
+        self.assertTrue(os.path.isfile("agent_facts.json.migrated"))
+        self.assertTrue(os.path.isfile("agent_facts.json.log.migrated"))
+        self.assertFalse(os.path.exists("agent_facts.json"))
+
+    def test_failed_migration_is_retried_after_later_writes(self):
+        real_save = agentfacts._FileShard.save
+        calls = []
+
+        def flaky_save(shard, data):
+            calls.append(shard.path)
+            if len(calls) == 2:
+                raise OSError("disk full")
+            real_save(shard, data)
+
+        with mock.patch.object(agentfacts._FileShard, "save", flaky_save):
+            AgentFacts()
+        self.assertTrue(os.path.isfile("agent_facts.json"))
+        # the app keeps running and writes before the next start, creating agent_facts/
+        AgentFacts().set("me", "card:self", {"y": 2})
+        AgentFacts().bulk_inc([("me", "wallet:me", {"balance": 1}, {})])
+
+        facts = AgentFacts()
+        self.assertEqual(facts.get("u/1", "wallet:u/1")["value"], {"balance": 30})
+        self.assertEqual(facts.get(None, "card:self")["value"], {"x": 1})
+        self.assertEqual(facts.get("me", "card:self")["value"], {"y": 2})
+        self.assertEqual(facts.get("me", "wallet:me")["value"], {"balance": 8})
+        self.assertTrue(os.path.isfile("agent_facts.json.migrated"))
+
+    def test_malformed_legacy_record_is_skipped(self):
+        with open("agent_facts.json") as f:
+            data = json.load(f)
+        data["broken"] = {"key": "wallet:x", "value": {"balance": 1}}  # no agent_id
+        data["junk"] = "not a record"
+        with open("agent_facts.json", "w") as f:
+            json.dump(data, f)
+        facts = AgentFacts()
+        self.assertEqual(facts.get("u/1", "wallet:u/1")["value"], {"balance": 30})
+        self.assertEqual(facts.get("me", "wallet:me")["value"], {"balance": 7})
+        self.assertTrue(os.path.isfile("agent_facts.json.migrated"))
+
+
+
+class MongoBackendTest(unittest.TestCase):
+    """Checks the exact filter / update documents sent to a mocked collection."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        self.facts = AgentFacts()
+        self.facts._use_mongo = True
+        self.facts._col = self.col = mock.Mock()
+        self.facts._now = lambda: "2026-01-01T00:00:00"
+
+    def test_debit_filters_on_balance_and_reports_match(self):
+        self.col.update_one.return_value.matched_count = 1
+        self.assertTrue(self.facts.debit("u", "wallet:u", "balance", 8, {"owner": "u"}))
+        self.col.update_one.assert_called_once_with(
+            {"agent_id": "u", "key": "wallet:u", "value.balance": {"$gte": 8}},
+            {"$inc": {"value.balance": -8}, "$set": {"value.owner": "u", "ts": "2026-01-01T00:00:00"}},
+        )
+
+    def test_debit_without_match_returns_false(self):
+        self.col.update_one.return_value.matched_count = 0
+        self.assertFalse(self.facts.debit("u", "wallet:u", "balance", 8))
+        (_, update), kwargs = self.col.update_one.call_args
+        self.assertNotIn("upsert", kwargs)  # a missing wallet must not be created with a negative balance
+        self.assertEqual(update["$inc"], {"value.balance": -8})
+
+    def test_bulk_inc_sends_dotted_inc_set_and_upserts_in_one_write(self):
+        ts = "2026-01-01T00:00:00"
+        self.facts.bulk_inc([("me", "wallet:me", {"balance": 8}, {"owner": "me"})],
+                            [("me", "txn:1", {"points": 8}), ("me", "txn:1", {"points": 9})])
+        self.col.bulk_write.assert_called_once_with([
+            UpdateOne({"agent_id": "me", "key": "wallet:me"},
+                      {"$inc": {"value.balance": 8}, "$set": {"value.owner": "me", "ts": ts}}, upsert=True),
+            UpdateOne({"agent_id": "me", "key": "txn:1"},
+                      {"$set": {"agent_id": "me", "key": "txn:1", "value": {"points": 9}, "ts": ts}}, upsert=True),
+        ], ordered=False)
+
+    def test_exists_fetches_only_the_id(self):
+        self.col.find_one.return_value = None
+        self.assertFalse(self.facts.exists("me", "q:u:1"))
+        self.col.find_one.assert_called_once_with({"agent_id": "me", "key": "q:u:1"}, {"_id": 1})
+
+    def test_list_projects_record_fields(self):
+        doc = {"agent_id": "me", "key": "k", "value": {}, "ts": "t"}
+        self.col.find.return_value.batch_size.return_value = [doc]
+        self.assertEqual(self.facts.list("me"), {"k": doc})
+        self.col.find.assert_called_once_with(
+            {"agent_id": "me"}, {"_id": 0, "agent_id": 1, "key": 1, "value": 1, "ts": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
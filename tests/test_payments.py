@@ -0,0 +1,189 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from nanda_adapter.core import payments
+
+
+class _FakeResponse:
+    def __init__(self, body: dict):
+        self.content = json.dumps(body).encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _claude_answer(text: str):
+    session = mock.Mock()
+    session.post.return_value = _FakeResponse({"content": [{"type": "text", "text": text}]})
+    return session
+
+
+class ClaudeCanAcceptPaymentTest(unittest.TestCase):
+    def setUp(self):
+        payments._ACCEPT_CACHE._data.clear()
+        patcher = mock.patch.object(payments, "ANTHROPIC_API_KEY", "test-key")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claude_false_rejects_card_with_economy(self):
+        session = _claude_answer("false")
+        with mock.patch.object(payments, "_claude_session", return_value=session):
+            self.assertFalse(payments._claude_can_accept_payment({"economy": {"currency": "POINTS"}}))
+        session.post.assert_called_once()
+
+    def test_claude_true_accepts_and_is_cached(self):
+        card = {"capabilities": {"payments": ["x402"]}}
+        session = _claude_answer("true")
+        with mock.patch.object(payments, "_claude_session", return_value=session):
+            self.assertTrue(payments._claude_can_accept_payment(card))
+            self.assertTrue(payments._claude_can_accept_payment(card))
+        session.post.assert_called_once()
+
+    def test_conclusive_heuristic_skips_claude(self):
+        card = {"economy": {"pricing": {}}, "capabilities": {"payments": ["payments.points"]}}
+        session = _claude_answer("false")
+        with mock.patch.object(payments, "_claude_session", return_value=session):
+            self.assertTrue(payments._claude_can_accept_payment(card))
+        session.post.assert_not_called()
+
+    def test_malformed_economy_goes_to_claude(self):
+        for econ in (None, "free"):
+            payments._ACCEPT_CACHE._data.clear()
+            session = _claude_answer("false")
+            with mock.patch.object(payments, "_claude_session", return_value=session):
+                self.assertFalse(payments._claude_can_accept_payment({"economy": econ}))
+            session.post.assert_called_once()
+
+    def test_string_capabilities_count_as_payment_signal(self):
+        session = _claude_answer("false")
+        with mock.patch.object(payments, "_claude_session", return_value=session):
+            card = {"economy": {"pricing": {}}, "capabilities": "payments.points"}
+            self.assertTrue(payments._claude_can_accept_payment(card))
+        session.post.assert_not_called()
+        with mock.patch.object(payments, "ANTHROPIC_API_KEY", None):
+            for caps in ("payments.points", "x402"):
+                self.assertTrue(payments._claude_can_accept_payment({"capabilities": caps}))
+            self.assertFalse(payments._claude_can_accept_payment({"capabilities": "chat"}))
+
+
+class SessionRetryTest(unittest.TestCase):
+    def _retry(self, session):
+        return session.get_adapter("https://example.com").max_retries
+
+    def test_idempotent_sessions_retry_post_on_5xx(self):
+        for session in (payments._registry_session(), payments._claude_session()):
+            self.assertTrue(self._retry(session).is_retry("POST", 503))
+
+    def test_a2a_session_does_not_retry_post_on_5xx(self):
+        self.assertFalse(self._retry(payments._session()).is_retry("POST", 503))
+
+
+class QuoteAndChargeTest(unittest.TestCase):
+    def setUp(self):
+        peer = {"agent_id": "peer", "agent_url": "http://peer"}
+        patches = [
+            mock.patch.object(payments, "_resolve_agent", return_value=peer),
+            mock.patch.object(payments, "_claude_can_accept_payment", return_value=True),
+            mock.patch.object(payments, "_seen", return_value=False),
+            mock.patch.object(payments, "_af_debit", return_value=True),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_quote_is_sent_only_after_charge_is_persisted(self):
+        calls = []
+        with mock.patch.object(payments, "_af_bulk_inc", side_effect=lambda *a: calls.append("write")), \
+             mock.patch.object(payments, "_send_a2a_safe", side_effect=lambda *a: calls.append("send") or {}):
+            result = payments.quote_and_charge_points_via_a2a("user", "peer", "What is a matrix?")
+        self.assertTrue(result["charged"])
+        self.assertEqual(calls, ["write", "write", "send"])  # credit, then interaction + txn records
+
+    def test_failed_credit_refunds_and_does_not_send_quote(self):
+        send = mock.Mock()
+        bulk_inc = mock.Mock(side_effect=[RuntimeError("mongo timeout"), None])
+        with mock.patch.object(payments, "_af_bulk_inc", bulk_inc), \
+             mock.patch.object(payments, "_send_a2a_safe", send):
+            with self.assertRaises(RuntimeError):
+                payments.quote_and_charge_points_via_a2a("user", "peer", "What is a matrix?")
+        send.assert_not_called()
+        (refund,), _ = bulk_inc.call_args
+        self.assertEqual([(a, d) for a, _, d, _ in refund], [("user", {"balance": 8})])
+
+    def test_failed_record_write_after_credit_does_not_refund(self):
+        send = mock.Mock()
+        bulk_inc = mock.Mock(side_effect=[None, RuntimeError("BulkWriteError on txn upsert")])
+        with mock.patch.object(payments, "_af_bulk_inc", bulk_inc), \
+             mock.patch.object(payments, "_send_a2a_safe", send):
+            with self.assertRaises(RuntimeError):
+                payments.quote_and_charge_points_via_a2a("user", "peer", "What is a matrix?")
+        send.assert_not_called()
+        credit, records = bulk_inc.call_args_list
+        self.assertEqual([(a, d) for a, _, d, _ in credit.args[0]], [(os.getenv("AGENT_ID", "default"), {"balance": 8})])
+        self.assertEqual(list(records.args[0]), [])  # records only, no refund increment
+
+    def test_repeat_question_failed_write_does_not_send(self):
+        send = mock.Mock()
+        with mock.patch.object(payments, "_seen", return_value=True), \
+             mock.patch.object(payments, "_af_bulk_inc", side_effect=RuntimeError("mongo timeout")), \
+             mock.patch.object(payments, "_send_a2a_safe", send):
+            with self.assertRaises(RuntimeError):
+                payments.quote_and_charge_points_via_a2a("user", "peer", "What is a matrix?")
+        send.assert_not_called()
+
+    def test_insufficient_points_charges_and_sends_nothing(self):
+        send, bulk_inc = mock.Mock(), mock.Mock()
+        with mock.patch.object(payments, "_af_debit", return_value=False), \
+             mock.patch.object(payments, "_points_get", return_value=3), \
+             mock.patch.object(payments, "_af_bulk_inc", bulk_inc), \
+             mock.patch.object(payments, "_send_a2a_safe", send):
+            result = payments.quote_and_charge_points_via_a2a("user", "peer", "What is a matrix?")
+        self.assertEqual(result, {"ok": False, "error": "insufficient_points", "required": 8, "available": 3})
+        send.assert_not_called()
+        (incs, _), _ = bulk_inc.call_args
+        self.assertEqual(list(incs), [])
+
+
+
+class QhashV1FallbackTest(unittest.TestCase):
+    QUESTION = "What is a matrix?"
+
+    def setUp(self):
+        peer = {"agent_id": "peer", "agent_url": "http://peer"}
+        # only the pre-blake2b (truncated SHA-256) key was recorded for this question
+        v1_key = f"q:user:{payments._qhash_v1(self.QUESTION)}"
+        patches = [
+            mock.patch.object(payments, "_resolve_agent", return_value=peer),
+            mock.patch.object(payments, "_claude_can_accept_payment", return_value=True),
+            mock.patch.object(payments, "_seen", side_effect=lambda aid, key: key == v1_key),
+            mock.patch.object(payments, "_af_debit", return_value=True),
+            mock.patch.object(payments, "_af_bulk_inc"),
+            mock.patch.object(payments, "_send_a2a_safe", return_value={}),
+            mock.patch.object(payments, "_now_iso", return_value="2026-10-15T12:00:00Z"),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _charged(self, until: str) -> bool:
+        with mock.patch.object(payments, "QHASH_V1_FALLBACK_UNTIL", until):
+            return payments.quote_and_charge_points_via_a2a("user", "peer", self.QUESTION)["charged"]
+
+    def test_legacy_key_counts_as_seen_before_cutoff(self):
+        self.assertFalse(self._charged("2026-10-16"))
+
+    def test_legacy_key_ignored_from_cutoff_on(self):
+        self.assertTrue(self._charged("2026-10-15"))
+        self.assertTrue(self._charged("2026-01-01"))
+
+    def test_empty_cutoff_disables_fallback(self):
+        self.assertTrue(self._charged(""))
+
+
+if __name__ == "__main__":
+    unittest.main()